@@ -343,6 +343,48 @@ def get_argument_parser():
             " The default is to follow the value of --sd3_clip_uncond_behaviour."
         ),
     )
+    parser.add_argument(
+        "--sd3_prompt_cache_size",
+        type=int,
+        default=64,
+        help=(
+            "SD3 keeps the text embeds of recently encoded prompts in (pinned) system memory, so that repeated prompts,"
+            " eg. the empty unconditional caption or validation prompts, skip the CLIP and T5 forward passes entirely."
+            " A prompt is only cached once it has been encoded a second time, as most captions are only seen once."
+            " This value sets the number of prompts kept in that cache. Set to 0 to disable it."
+            " The cache is disabled when --train_text_encoder is used. Default: 64"
+        ),
+    )
+    parser.add_argument(
+        "--sd3_t5_dynamic_padding",
+        action="store_true",
+        help=(
+            "Instead of padding every prompt to --tokenizer_max_length before running T5, SD3 can group prompts of similar length"
+            " and pad each group only to its longest prompt, masking the padding out of T5's attention and zero-padding the outputs back to full length afterward."
+            " This greatly reduces the T5 compute spent on short captions, but the embeds differ slightly from the unmasked default,"
+            " so existing text embed caches should be cleared. Requires --t5_padding=zero."
+        ),
+    )
+    parser.add_argument(
+        "--sd3_clip_cuda_graphs",
+        action="store_true",
+        help=(
+            "Capture the SD3 CLIP-L and CLIP-G forward passes as CUDA graphs and replay them when encoding prompts,"
+            " which removes most of their kernel launch overhead. One graph is kept per batch size."
+            " This has no effect unless training on CUDA with frozen, unquantised CLIP text encoders."
+        ),
+    )
+    parser.add_argument(
+        "--sd3_text_encoder_compile",
+        action="store_true",
+        help=(
+            "Compile the frozen SD3 text encoders with torch.compile() before they first encode prompts."
+            " This fuses many of their smaller kernels, speeding up text embed caching after a one-time compile per input shape."
+            " CLIP encoders already using --sd3_clip_cuda_graphs and offloaded encoders are left uncompiled."
+            " Offloading and compiling don't combine, so a compiled T5 stays on the accelerator instead of being offloaded"
+            " to system memory once the text embeds are cached."
+        ),
+    )
     parser.add_argument(
         "--lora_type",
         type=str.lower,
@@ -2309,6 +2351,19 @@ def parse_cmdline_args(input_args=None, exit_on_error: bool = False):
         and args.base_model_default_dtype == "bf16"
     )
     model_is_quantized = args.base_model_precision != "no_change"
+    if args.base_model_precision == "fp8dq-torchao":
+        raise ValueError(
+            "fp8dq-torchao is an inference-only precision level, and can only be used for frozen text encoders via --text_encoder_*_precision."
+        )
+    if args.train_text_encoder:
+        for text_encoder_idx in [1, 2]:
+            if (
+                getattr(args, f"text_encoder_{text_encoder_idx}_precision", None)
+                == "fp8dq-torchao"
+            ):
+                raise ValueError(
+                    f"fp8dq-torchao is an inference-only precision level, and can't be used for --text_encoder_{text_encoder_idx}_precision with --train_text_encoder."
+                )
     # check optimiser validity
     chosen_optimizer = args.optimizer
     is_optimizer_deprecated(chosen_optimizer)
@@ -16,6 +16,7 @@ from helpers.training.custom_schedule import (
     segmented_timestep_selection,
 )
 from helpers.training.min_snr_gamma import compute_snr
+from transformers import PreTrainedModel
 from transformers.utils import ContextManagers
 from helpers.training.adapter import load_lora_weights
 from helpers.training.deepspeed import (
@@ -283,35 +284,40 @@ class ModelFoundation(ABC):
         text_encoder_two_ = None
 
         # 1. Identify models by type comparison
+        #    The target types don't change between iterations, so unwrap them once.
+        denoiser_type = type(self.unwrap_model(self.model))
+        text_encoders = getattr(self, "text_encoders", None) or []
+        text_encoder_one_type = (
+            type(self.unwrap_model(text_encoders[0]))
+            if len(text_encoders) > 0
+            else None
+        )
+        text_encoder_two_type = (
+            type(self.unwrap_model(text_encoders[1]))
+            if len(text_encoders) > 1
+            else None
+        )
         while len(models) > 0:
             model = models.pop()
             unwrapped_model = self.unwrap_model(model)
 
             # Compare unwrapped type to main model's unwrapped type
-            if isinstance(unwrapped_model, type(self.unwrap_model(self.model))):
+            if isinstance(unwrapped_model, denoiser_type):
                 denoiser = model  # e.g., the "transformer" or "unet"
             # If your text_encoders exist:
-            elif (
-                getattr(self, "text_encoders", None)
-                and len(self.text_encoders) > 0
-                and isinstance(
-                    unwrapped_model, type(self.unwrap_model(self.text_encoders[0]))
-                )
+            elif text_encoder_one_type is not None and isinstance(
+                unwrapped_model, text_encoder_one_type
             ):
                 text_encoder_one_ = model
-            elif (
-                getattr(self, "text_encoders", None)
-                and len(self.text_encoders) > 1
-                and isinstance(
-                    unwrapped_model, type(self.unwrap_model(self.text_encoders[1]))
-                )
+            elif text_encoder_two_type is not None and isinstance(
+                unwrapped_model, text_encoder_two_type
             ):
                 text_encoder_two_ = model
             else:
                 raise ValueError(
                     f"Unexpected model type in load_lora_weights: {model.__class__}\n"
                     f"Unwrapped: {unwrapped_model.__class__}\n"
-                    f"Expected main model type {type(self.unwrap_model(self.model))}"
+                    f"Expected main model type {denoiser_type}"
                 )
 
         # 2. Get the LoRA state dict from the pipeline's directory
@@ -322,13 +328,13 @@ class ModelFoundation(ABC):
 
         # 3. Extract keys for the main model (which uses self.MODEL_TYPE.value as the prefix)
         #    For example, "transformer." or "unet." is stripped out.
-        key_to_replace = self.MODEL_TYPE.value
-        denoiser_sd = {}
-        for k, v in lora_state_dict.items():
-            prefix = f"{key_to_replace}."
-            if k.startswith(prefix):
-                new_key = k.replace(prefix, "")
-                denoiser_sd[new_key] = v
+        prefix = f"{self.MODEL_TYPE.value}."
+        prefix_length = len(prefix)
+        denoiser_sd = {
+            k[prefix_length:]: v
+            for k, v in lora_state_dict.items()
+            if k.startswith(prefix)
+        }
 
         # Convert them to "PEFT" format if needed.
         # (Typically we call convert_unet_state_dict_to_peft on the denoiser's keys.)
@@ -415,7 +421,8 @@ class ModelFoundation(ABC):
             self.vae.to(target_device)
         if self.text_encoders is not None:
             for text_encoder in self.text_encoders:
-                if text_encoder.device != "meta":
+                # offloaded or unloaded encoders hold meta tensors, which can't be moved.
+                if text_encoder.device.type != "meta":
                     text_encoder.to(target_device)
         self.move_extra_models(target_device)
 
@@ -568,7 +575,16 @@ class ModelFoundation(ABC):
             or len(self.TEXT_ENCODER_CONFIGURATION) == 0
         ):
             return
+        if move_to_device and self.accelerator is None:
+            raise ValueError(
+                "Text encoders must be loaded after the accelerator is initialised, so that each process places them on its own device."
+            )
         self.load_text_tokenizer()
+        # under DeepSpeed, parameter placement is left to the engine.
+        uses_deepspeed = (
+            getattr(getattr(self.accelerator, "state", None), "deepspeed_plugin", None)
+            is not None
+        )
 
         text_encoder_idx = 0
         with ContextManagers(deepspeed_zero_init_disabled_context_manager()):
@@ -577,6 +593,10 @@ class ModelFoundation(ABC):
                 text_encoder_config,
             ) in self.TEXT_ENCODER_CONFIGURATION.items():
                 text_encoder_idx += 1
+                # the first encoder's attribute is `text_encoder`, but its option is --text_encoder_1_precision.
+                text_encoder_precision = getattr(
+                    self.config, f"text_encoder_{text_encoder_idx}_precision", None
+                )
                 # load_tes returns a variant and three text encoders
                 signature = inspect.signature(text_encoder_config["model"])
                 extra_kwargs = {}
@@ -601,6 +621,16 @@ class ModelFoundation(ABC):
                     extra_kwargs["quantization_config"] = TorchAoConfig(
                         quant_type=quant_config
                     )
+                elif (
+                    move_to_device
+                    and not uses_deepspeed
+                    and issubclass(text_encoder_config["model"], PreTrainedModel)
+                    and text_encoder_precision in ["no_change", None]
+                ):
+                    # load the weights straight onto this process' device in the target dtype,
+                    # rather than staging a full-precision copy in system memory on every rank first.
+                    extra_kwargs["device_map"] = {"": self.accelerator.device}
+                    extra_kwargs["torch_dtype"] = self.config.weight_dtype
 
                 text_encoder = text_encoder_config["model"].from_pretrained(
                     text_encoder_path,
@@ -624,9 +654,7 @@ class ModelFoundation(ABC):
                     #     text_encoder = NovelAIT5EncoderModel.from_hf_model(text_encoder)
                     pass
 
-                if move_to_device and getattr(
-                    self.config, f"{attr_name}_precision", None
-                ) in ["no_change", None]:
+                if move_to_device and text_encoder_precision in ["no_change", None]:
                     logger.info(f"Moving {text_encoder_config.get('name')} to GPU")
                     text_encoder.to(
                         self.accelerator.device,
@@ -639,6 +667,15 @@ class ModelFoundation(ABC):
         if self.text_encoders is not None:
             return self.text_encoders[index] if index in self.text_encoders else None
 
+    def offload_frozen_text_encoders(self):
+        """
+        Offload any text encoders that stay loaded during training without being trained,
+        eg. when text encoder LoRAs are trained alongside the model.
+
+        This is a stub and can be optionally implemented in subclasses.
+        """
+        pass
+
     def unload_text_encoder(self):
         if self.text_encoders is not None:
             for text_encoder in self.text_encoders:
@@ -1,4 +1,8 @@
 import torch, os, logging
+import contextlib
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from helpers.models.common import (
     ImageModelFoundation,
     PredictionTypes,
@@ -8,7 +12,7 @@ from helpers.models.common import (
 from transformers import (
     T5TokenizerFast,
     T5EncoderModel,
-    CLIPTokenizer,
+    CLIPTokenizerFast,
     CLIPTextModelWithProjection,
 )
 from helpers.models.sd3.transformer import SD3Transformer2DModel
@@ -16,7 +20,7 @@ from helpers.models.sd3.pipeline import (
     StableDiffusion3Pipeline,
     StableDiffusion3Img2ImgPipeline,
 )
-from diffusers import AutoencoderKL, SD3ControlNetModel
+from diffusers import AutoencoderKL
 
 logger = logging.getLogger(__name__)
 is_primary_process = True
@@ -28,6 +32,110 @@ logger.setLevel(
 )
 
 
+def _repeat_per_prompt(
+    embeds: torch.Tensor, batch_size: int, num_images_per_prompt: int
+):
+    """
+    Repeats each prompt's entry along the batch dimension, once per generation per prompt.
+    """
+    # the expand is free; only the reshape materialises the copies.
+    return (
+        embeds.unsqueeze(1)
+        .expand(batch_size, num_images_per_prompt, *embeds.shape[1:])
+        .reshape(batch_size * num_images_per_prompt, *embeds.shape[1:])
+    )
+
+
+def _tokenize_sd3_prompt_with_t5(
+    tokenizer,
+    prompt,
+    max_sequence_length: int = 77,
+    dynamic_padding: bool = False,
+):
+    prompt = [prompt] if isinstance(prompt, str) else prompt
+    if dynamic_padding:
+        # left unpadded, so that prompts can be grouped by length before encoding.
+        return tokenizer(
+            prompt,
+            padding=False,
+            max_length=max_sequence_length,
+            truncation=True,
+            add_special_tokens=True,
+        )
+    return tokenizer(
+        prompt,
+        padding="max_length",
+        max_length=max_sequence_length,
+        truncation=True,
+        add_special_tokens=True,
+        return_tensors="pt",
+    )
+
+
+def _encode_t5_length_buckets(
+    text_encoder,
+    tokenizer,
+    input_ids: list,
+    device=None,
+    max_sequence_length: int = 77,
+    num_buckets: int = 4,
+    min_bucket_size: int = 8,
+):
+    """
+    Runs T5 over groups of similarly-sized prompts, each padded only to its own longest prompt,
+    with the padding masked out of attention. As attention is quadratic in the sequence length,
+    this avoids spending most of the compute on padding when prompt lengths are skewed.
+
+    A group is only split off once it holds `min_bucket_size` prompts and the next prompt is over twice
+    the length of its shortest one, so that small or evenly-sized batches still run in a single forward pass.
+
+    Returns:
+        The embeds zero-padded to max_sequence_length, in the original prompt order.
+    """
+    order = sorted(range(len(input_ids)), key=lambda idx: len(input_ids[idx]))
+    lengths = [len(input_ids[idx]) for idx in order]
+    bucket_starts = [0]
+    for position in range(1, len(order)):
+        if (
+            len(bucket_starts) < num_buckets
+            and position - bucket_starts[-1] >= min_bucket_size
+            and len(order) - position >= min_bucket_size
+            and lengths[position] > 2 * lengths[bucket_starts[-1]]
+        ):
+            bucket_starts.append(position)
+    bucket_ends = bucket_starts[1:] + [len(order)]
+    prompt_embeds = None
+    for start, end in zip(bucket_starts, bucket_ends):
+        bucket = order[start:end]
+        bucket_inputs = tokenizer.pad(
+            {"input_ids": [input_ids[idx] for idx in bucket]},
+            padding="longest",
+            return_tensors="pt",
+        )
+        bucket_embeds = text_encoder(
+            bucket_inputs.input_ids.to(device, non_blocking=True),
+            attention_mask=bucket_inputs.attention_mask.to(device, non_blocking=True),
+        )[0]
+        if prompt_embeds is None:
+            prompt_embeds = bucket_embeds.new_zeros(
+                len(input_ids), max_sequence_length, bucket_embeds.shape[-1]
+            )
+        prompt_embeds[bucket, : bucket_embeds.shape[1]] = bucket_embeds
+
+    return prompt_embeds
+
+
+def _tokenize_sd3_prompt_with_clip(tokenizer, prompt, max_token_length: int = 77):
+    prompt = [prompt] if isinstance(prompt, str) else prompt
+    return tokenizer(
+        prompt,
+        padding="max_length",
+        max_length=max_token_length,
+        truncation=True,
+        return_tensors="pt",
+    )
+
+
 def _encode_sd3_prompt_with_t5(
     text_encoder,
     tokenizer,
@@ -36,40 +144,118 @@ def _encode_sd3_prompt_with_t5(
     device=None,
     zero_padding_tokens: bool = True,
     max_sequence_length: int = 77,
+    dynamic_padding: bool = False,
+    text_inputs=None,
 ):
     prompt = [prompt] if isinstance(prompt, str) else prompt
     batch_size = len(prompt)
 
-    text_inputs = tokenizer(
-        prompt,
-        padding="max_length",
-        max_length=max_sequence_length,
-        truncation=True,
-        add_special_tokens=True,
-        return_tensors="pt",
-    )
+    if text_inputs is None:
+        text_inputs = _tokenize_sd3_prompt_with_t5(
+            tokenizer,
+            prompt,
+            max_sequence_length=max_sequence_length,
+            dynamic_padding=dynamic_padding,
+        )
     text_input_ids = text_inputs.input_ids
-    prompt_embeds = text_encoder(text_input_ids.to(device))[0]
+    # the padded positions as a (B, L, 1) bool, built once on the host so that
+    # the device only receives a single byte per token and needs no dtype promotion.
+    padding_mask = torch.ones(batch_size, max_sequence_length, 1, dtype=torch.bool)
+    if dynamic_padding:
+        for idx, prompt_input_ids in enumerate(text_input_ids):
+            padding_mask[idx, : len(prompt_input_ids)] = False
+        # the outputs are padded back out with zeros so that the embed shape is unchanged.
+        prompt_embeds = _encode_t5_length_buckets(
+            text_encoder,
+            tokenizer,
+            text_input_ids,
+            device=device,
+            max_sequence_length=max_sequence_length,
+        )
+    else:
+        padding_mask[:, : text_input_ids.shape[1], 0] = text_inputs.attention_mask == 0
+        prompt_embeds = text_encoder(text_input_ids.to(device, non_blocking=True))[0]
 
+    # the encoder already returns its outputs on `device`, usually in its own dtype.
     dtype = text_encoder.dtype
-    prompt_embeds = prompt_embeds.to(dtype=dtype, device=device)
+    if prompt_embeds.dtype != dtype:
+        prompt_embeds = prompt_embeds.to(dtype)
 
-    _, seq_len, _ = prompt_embeds.shape
-
-    # duplicate text embeddings and attention mask for each generation per prompt, using mps friendly method
-    prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
-    prompt_embeds = prompt_embeds.view(batch_size * num_images_per_prompt, seq_len, -1)
-    attention_mask = text_inputs.attention_mask.to(device)
+    if num_images_per_prompt > 1:
+        # duplicate text embeddings and attention mask for each generation per prompt.
+        prompt_embeds = _repeat_per_prompt(
+            prompt_embeds, batch_size, num_images_per_prompt
+        )
+        padding_mask = _repeat_per_prompt(
+            padding_mask, batch_size, num_images_per_prompt
+        )
 
     if zero_padding_tokens:
         # for some reason, SAI's reference code doesn't bother to mask the prompt embeddings.
         # this can lead to a problem where the model fails to represent short and long prompts equally well.
         # additionally, the model learns the bias of the prompt embeds' noise.
-        return prompt_embeds * attention_mask.unsqueeze(-1).expand(prompt_embeds.shape)
+        padding_mask = padding_mask.to(device, non_blocking=True)
+        if prompt_embeds.requires_grad:
+            return prompt_embeds.masked_fill(padding_mask, 0)
+        return prompt_embeds.masked_fill_(padding_mask, 0)
     else:
         return prompt_embeds
 
 
+class _CLIPCUDAGraphRunner:
+    """
+    Replays CUDA graph captures of a frozen CLIP text encoder's forward pass.
+
+    CLIP inputs are always padded to the same length, so each batch size only needs capturing once.
+    Batch sizes beyond `max_graphs` fall back to the eager forward pass.
+    """
+
+    def __init__(self, text_encoder, max_graphs: int = 4, warmup_steps: int = 3):
+        self.text_encoder = text_encoder
+        self.max_graphs = max_graphs
+        self.warmup_steps = warmup_steps
+        self.graphs = {}
+        self._weight_ptr = None
+
+    def __call__(self, input_ids: torch.Tensor):
+        weight_ptr = next(self.text_encoder.parameters()).data_ptr()
+        if weight_ptr != self._weight_ptr:
+            # the weights moved, so the captured graphs point at stale memory.
+            self.graphs = {}
+            self._weight_ptr = weight_ptr
+        batch_size = input_ids.shape[0]
+        if batch_size not in self.graphs:
+            if len(self.graphs) >= self.max_graphs:
+                return self._forward(input_ids)
+            self.graphs[batch_size] = self._capture(input_ids)
+        graph, static_input_ids, static_outputs = self.graphs[batch_size]
+        static_input_ids.copy_(input_ids)
+        graph.replay()
+        # the next replay overwrites the static outputs.
+        return tuple(output.clone() for output in static_outputs)
+
+    def _forward(self, input_ids: torch.Tensor):
+        output = self.text_encoder(input_ids, output_hidden_states=True)
+        return output[0], output.hidden_states[-2]
+
+    def _capture(self, input_ids: torch.Tensor):
+        logger.debug(
+            f"Capturing CUDA graph for {self.text_encoder.__class__.__name__} at batch size {input_ids.shape[0]}"
+        )
+        static_input_ids = input_ids.clone()
+        current_stream = torch.cuda.current_stream(input_ids.device)
+        warmup_stream = torch.cuda.Stream(device=input_ids.device)
+        warmup_stream.wait_stream(current_stream)
+        with torch.cuda.stream(warmup_stream):
+            for _ in range(self.warmup_steps):
+                self._forward(static_input_ids)
+        current_stream.wait_stream(warmup_stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_outputs = self._forward(static_input_ids)
+        return graph, static_input_ids, static_outputs
+
+
 def _encode_sd3_prompt_with_clip(
     text_encoder,
     tokenizer,
@@ -77,28 +263,32 @@ def _encode_sd3_prompt_with_clip(
     device=None,
     num_images_per_prompt: int = 1,
     max_token_length: int = 77,
+    text_inputs=None,
+    graph_runner: _CLIPCUDAGraphRunner = None,
 ):
     prompt = [prompt] if isinstance(prompt, str) else prompt
     batch_size = len(prompt)
 
-    text_inputs = tokenizer(
-        prompt,
-        padding="max_length",
-        max_length=max_token_length,
-        truncation=True,
-        return_tensors="pt",
-    )
-    text_input_ids = text_inputs.input_ids
-    prompt_embeds = text_encoder(text_input_ids.to(device), output_hidden_states=True)
+    if text_inputs is None:
+        text_inputs = _tokenize_sd3_prompt_with_clip(
+            tokenizer, prompt, max_token_length=max_token_length
+        )
+    text_input_ids = text_inputs.input_ids.to(device, non_blocking=True)
+    if graph_runner is not None:
+        pooled_prompt_embeds, prompt_embeds = graph_runner(text_input_ids)
+    else:
+        prompt_embeds = text_encoder(text_input_ids, output_hidden_states=True)
+        pooled_prompt_embeds = prompt_embeds[0]
+        prompt_embeds = prompt_embeds.hidden_states[-2]
+    dtype = text_encoder.dtype
+    if prompt_embeds.dtype != dtype:
+        prompt_embeds = prompt_embeds.to(dtype)
 
-    pooled_prompt_embeds = prompt_embeds[0]
-    prompt_embeds = prompt_embeds.hidden_states[-2]
-    prompt_embeds = prompt_embeds.to(dtype=text_encoder.dtype, device=device)
+    if num_images_per_prompt == 1:
+        return prompt_embeds, pooled_prompt_embeds
 
-    _, seq_len, _ = prompt_embeds.shape
-    # duplicate text embeddings for each generation per prompt, using mps friendly method
-    prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
-    prompt_embeds = prompt_embeds.view(batch_size * num_images_per_prompt, seq_len, -1)
+    # duplicate text embeddings for each generation per prompt.
+    prompt_embeds = _repeat_per_prompt(prompt_embeds, batch_size, num_images_per_prompt)
 
     return prompt_embeds, pooled_prompt_embeds
 
@@ -128,16 +318,19 @@ class SD3(ImageModelFoundation):
     }
     MODEL_LICENSE = "other"
 
+    # smaller batches are tokenised inline, as handing them to a thread costs more than tokenising them.
+    TOKENIZER_THREAD_MIN_PROMPTS = 16
+
     TEXT_ENCODER_CONFIGURATION = {
         "text_encoder": {
             "name": "CLIP-L/14",
-            "tokenizer": CLIPTokenizer,
+            "tokenizer": CLIPTokenizerFast,
             "tokenizer_subfolder": "tokenizer",
             "model": CLIPTextModelWithProjection,
         },
         "text_encoder_2": {
             "name": "CLIP-G/14",
-            "tokenizer": CLIPTokenizer,
+            "tokenizer": CLIPTokenizerFast,
             "subfolder": "text_encoder_2",
             "tokenizer_subfolder": "tokenizer_2",
             "model": CLIPTextModelWithProjection,
@@ -151,6 +344,19 @@ class SD3(ImageModelFoundation):
         },
     }
 
+    def __init__(self, config, accelerator):
+        super().__init__(config, accelerator)
+        # host-side LRU of recently encoded prompts, keyed by _prompt_cache_key.
+        self._prompt_cache = OrderedDict()
+        # keys of prompts encoded once so far; only prompts that repeat are given a cache entry.
+        self._prompt_cache_seen = OrderedDict()
+        # one CUDA stream per text encoder, created on first use.
+        self._text_encoder_streams = None
+        self._tokenizer_executor = None
+        self._clip_graph_runners = {}
+        # (CLIP-L width, CLIP-L + CLIP-G width, T5 width), read from the text encoder configs on first use.
+        self._prompt_embed_widths = None
+
     def _format_text_embedding(self, text_embedding: torch.Tensor):
         """
         Models can optionally format the stored text embedding, eg. in a dict, or
@@ -197,45 +403,353 @@ class SD3(ImageModelFoundation):
         Returns:
             Text encoder output (raw)
         """
+        zero_padding_tokens = True if self.config.t5_padding == "zero" else False
+        cache_key = self._prompt_cache_key(
+            prompts,
+            max_sequence_length=self.config.tokenizer_max_length,
+            zero_padding_tokens=zero_padding_tokens,
+            dynamic_padding=self.config.sd3_t5_dynamic_padding,
+        )
+        cached_embeds = self._get_cached_prompt_embeds(cache_key)
+        if cached_embeds is not None:
+            return cached_embeds
+
         num_images_per_prompt = 1
+        self._setup_text_encoder_streams()
+        self._compile_text_encoders()
 
         clip_tokenizers = self.tokenizers[:2]
         clip_text_encoders = self.text_encoders[:2]
 
-        clip_prompt_embeds_list = []
-        clip_pooled_prompt_embeds_list = []
-        for tokenizer, text_encoder in zip(clip_tokenizers, clip_text_encoders):
-            prompt_embeds, pooled_prompt_embeds = _encode_sd3_prompt_with_clip(
-                text_encoder=text_encoder,
-                tokenizer=tokenizer,
-                prompt=prompts,
-                device=self.accelerator.device,
-                num_images_per_prompt=num_images_per_prompt,
+        # tokenise everything up-front, so that for larger batches T5's tokeniser
+        # runs in the background while the CLIP encoders are busy instead of after them.
+        clip_text_inputs = [
+            self._submit_tokenization(
+                prompts, _tokenize_sd3_prompt_with_clip, tokenizer, prompts
             )
-            clip_prompt_embeds_list.append(prompt_embeds)
-            clip_pooled_prompt_embeds_list.append(pooled_prompt_embeds)
-
-        clip_prompt_embeds = torch.cat(clip_prompt_embeds_list, dim=-1)
-        pooled_prompt_embeds = torch.cat(clip_pooled_prompt_embeds_list, dim=-1)
-        zero_padding_tokens = True if self.config.t5_padding == "zero" else False
-        t5_prompt_embed = _encode_sd3_prompt_with_t5(
-            self.text_encoders[-1],
+            for tokenizer in clip_tokenizers
+        ]
+        t5_text_inputs = self._submit_tokenization(
+            prompts,
+            _tokenize_sd3_prompt_with_t5,
             self.tokenizers[-1],
-            prompt=prompts,
-            num_images_per_prompt=num_images_per_prompt,
-            device=self.accelerator.device,
-            zero_padding_tokens=zero_padding_tokens,
+            prompts,
             max_sequence_length=self.config.tokenizer_max_length,
+            dynamic_padding=self.config.sd3_t5_dynamic_padding,
         )
 
-        clip_prompt_embeds = torch.nn.functional.pad(
-            clip_prompt_embeds,
-            (0, t5_prompt_embed.shape[-1] - clip_prompt_embeds.shape[-1]),
+        # the CLIP encoders are small enough to run alongside T5 on their own streams.
+        def encode_with_clip(idx):
+            with self._text_encoder_stream(idx), self._text_encoder_grad_context(idx):
+                return _encode_sd3_prompt_with_clip(
+                    text_encoder=clip_text_encoders[idx],
+                    tokenizer=clip_tokenizers[idx],
+                    prompt=prompts,
+                    device=self.accelerator.device,
+                    num_images_per_prompt=num_images_per_prompt,
+                    text_inputs=clip_text_inputs[idx].result(),
+                    graph_runner=self._get_clip_graph_runner(idx),
+                )
+
+        clip_l_prompt_embeds, clip_l_pooled_prompt_embeds = encode_with_clip(0)
+        clip_g_prompt_embeds, clip_g_pooled_prompt_embeds = encode_with_clip(1)
+
+        with self._text_encoder_stream(2), self._text_encoder_grad_context(2):
+            t5_prompt_embed = _encode_sd3_prompt_with_t5(
+                self.text_encoders[-1],
+                self.tokenizers[-1],
+                prompt=prompts,
+                num_images_per_prompt=num_images_per_prompt,
+                device=self.accelerator.device,
+                zero_padding_tokens=zero_padding_tokens,
+                max_sequence_length=self.config.tokenizer_max_length,
+                dynamic_padding=self.config.sd3_t5_dynamic_padding,
+                text_inputs=t5_text_inputs.result(),
+            )
+        self._join_text_encoder_streams(
+            clip_l_prompt_embeds,
+            clip_l_pooled_prompt_embeds,
+            clip_g_prompt_embeds,
+            clip_g_pooled_prompt_embeds,
+            t5_prompt_embed,
         )
-        prompt_embeds = torch.cat([clip_prompt_embeds, t5_prompt_embed], dim=-2)
+
+        pooled_prompt_embeds = torch.cat(
+            (clip_l_pooled_prompt_embeds, clip_g_pooled_prompt_embeds), dim=-1
+        )
+        # the CLIP embeds are concatenated, zero-padded out to T5's width and stacked ahead of the T5 embeds.
+        # writing all of them into one buffer avoids materialising the joined CLIP embeds separately.
+        clip_l_dim, clip_dim, t5_dim = self._get_prompt_embed_widths()
+        batch_size, clip_length, _ = clip_l_prompt_embeds.shape
+        prompt_embeds = clip_l_prompt_embeds.new_empty(
+            batch_size,
+            clip_length + t5_prompt_embed.shape[-2],
+            t5_dim,
+            dtype=torch.promote_types(
+                torch.promote_types(
+                    clip_l_prompt_embeds.dtype, clip_g_prompt_embeds.dtype
+                ),
+                t5_prompt_embed.dtype,
+            ),
+        )
+        prompt_embeds[:, :clip_length, :clip_l_dim].copy_(clip_l_prompt_embeds)
+        prompt_embeds[:, :clip_length, clip_l_dim:clip_dim].copy_(clip_g_prompt_embeds)
+        prompt_embeds[:, :clip_length, clip_dim:].zero_()
+        prompt_embeds[:, clip_length:].copy_(t5_prompt_embed)
+        self._cache_prompt_embeds(cache_key, prompt_embeds, pooled_prompt_embeds)
 
         return prompt_embeds, pooled_prompt_embeds
 
+    def _submit_tokenization(self, prompts: list, tokenize_fn, *args, **kwargs):
+        """
+        Returns a Future for the tokeniser output, running it on the tokeniser thread pool only for larger batches.
+        """
+        if len(prompts) < self.TOKENIZER_THREAD_MIN_PROMPTS:
+            text_inputs = Future()
+            text_inputs.set_result(tokenize_fn(*args, **kwargs))
+            return text_inputs
+        if self._tokenizer_executor is None:
+            self._tokenizer_executor = ThreadPoolExecutor(max_workers=3)
+        return self._tokenizer_executor.submit(tokenize_fn, *args, **kwargs)
+
+    def _get_prompt_embed_widths(self):
+        """
+        Returns the column boundaries of the joined prompt embeds, which are fixed by the text encoder configs.
+        """
+        if self._prompt_embed_widths is None:
+            clip_l_config, clip_g_config, t5_config = (
+                text_encoder.config for text_encoder in self.text_encoders
+            )
+            self._prompt_embed_widths = (
+                clip_l_config.hidden_size,
+                clip_l_config.hidden_size + clip_g_config.hidden_size,
+                t5_config.d_model,
+            )
+        return self._prompt_embed_widths
+
+    def _setup_text_encoder_streams(self):
+        if self._text_encoder_streams is not None:
+            return
+        if getattr(self.accelerator.device, "type", None) != "cuda":
+            return
+        self._text_encoder_streams = [
+            torch.cuda.Stream(device=self.accelerator.device) for _ in range(3)
+        ]
+
+    def _text_encoder_stream(self, index: int):
+        """
+        Returns a context manager that runs the enclosed work on text encoder `index`'s stream.
+        Off CUDA, this does nothing.
+        """
+        if self._text_encoder_streams is None:
+            return contextlib.nullcontext()
+        stream = self._text_encoder_streams[index]
+        # anything queued before this call must be visible to the side stream.
+        stream.wait_stream(torch.cuda.current_stream(self.accelerator.device))
+        return torch.cuda.stream(stream)
+
+    def _text_encoder_grad_context(self, index: int):
+        """
+        Returns a no_grad context unless text encoder `index` is being trained.
+        T5 is never trained, and the CLIP encoders are frozen without --train_text_encoder.
+        """
+        if index < 2 and self.config.train_text_encoder:
+            return contextlib.nullcontext()
+        return torch.no_grad()
+
+    def _compile_text_encoders(self):
+        """
+        Compiles the frozen text encoders in-place with torch.compile, when --sd3_text_encoder_compile is set.
+
+        This happens on first use rather than at load time, so that quantisation has already been applied.
+        """
+        if not self.config.sd3_text_encoder_compile:
+            return
+        for index, text_encoder in enumerate(self.text_encoders):
+            if (
+                text_encoder is None
+                or getattr(text_encoder, "_compiled_call_impl", None) is not None
+            ):
+                continue
+            if index < 2 and (
+                self.config.train_text_encoder
+                or self._get_clip_graph_runner(index) is not None
+            ):
+                # trained encoders will still gain adapters, and graphed ones don't need it.
+                continue
+            if getattr(text_encoder, "_hf_hook", None) is not None:
+                # offloaded weights are moved by hooks, which don't trace well.
+                continue
+            logger.info(
+                f"Compiling {text_encoder.__class__.__name__} with torch.compile."
+            )
+            # with dynamic padding, T5 sees many sequence lengths, so it's compiled with dynamic shapes.
+            text_encoder.compile(
+                dynamic=index == 2 and bool(self.config.sd3_t5_dynamic_padding)
+            )
+
+    def _get_clip_graph_runner(self, index: int):
+        """
+        Returns the CUDA graph runner for CLIP encoder `index`, or None when it should run eagerly.
+        """
+        if (
+            not self.config.sd3_clip_cuda_graphs
+            or self.config.train_text_encoder
+            or getattr(self.accelerator.device, "type", None) != "cuda"
+            # quantised layers aren't guaranteed to be capturable.
+            or getattr(self.config, f"text_encoder_{index + 1}_precision", None)
+            not in ["no_change", None]
+        ):
+            return None
+        text_encoder = self.text_encoders[index]
+        runner = self._clip_graph_runners.get(index)
+        if runner is None or runner.text_encoder is not text_encoder:
+            runner = _CLIPCUDAGraphRunner(text_encoder)
+            self._clip_graph_runners[index] = runner
+        return runner
+
+    def _join_text_encoder_streams(self, *outputs):
+        """
+        Makes the current stream wait on the text encoder streams, and hands the outputs over to it.
+        """
+        if self._text_encoder_streams is None:
+            return
+        current_stream = torch.cuda.current_stream(self.accelerator.device)
+        for stream in self._text_encoder_streams:
+            current_stream.wait_stream(stream)
+        for output in outputs:
+            # stops the allocator from reusing these for the side streams while still in use.
+            output.record_stream(current_stream)
+
+    def _prompt_cache_enabled(self) -> bool:
+        # the text encoders change underneath us when they're being trained.
+        return (
+            int(self.config.sd3_prompt_cache_size or 0) > 0
+            and not self.config.train_text_encoder
+        )
+
+    @staticmethod
+    def _prompt_cache_key(
+        prompts: list,
+        max_sequence_length: int,
+        zero_padding_tokens: bool,
+        dynamic_padding: bool = False,
+    ) -> str:
+        prompts = [prompts] if isinstance(prompts, str) else prompts
+        # hash the prompts so that long captions don't end up as dict keys.
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update("\x00".join(prompts).encode("utf-8"))
+        return f"{digest.hexdigest()}-{max_sequence_length}-{zero_padding_tokens}-{dynamic_padding}"
+
+    def _get_cached_prompt_embeds(self, cache_key: str):
+        if not self._prompt_cache_enabled() or cache_key not in self._prompt_cache:
+            return None
+        self._prompt_cache.move_to_end(cache_key)
+        host_embeds, copy_event = self._prompt_cache[cache_key]
+        if copy_event is not None:
+            # the copy to the host may still be in flight; queue up behind it rather than blocking.
+            torch.cuda.current_stream().wait_event(copy_event)
+        # the host copies are pinned, so these copies do not block the caller.
+        device_embeds = []
+        for embed in host_embeds:
+            device_embed = embed.to(self.accelerator.device, non_blocking=True)
+            if device_embed is embed:
+                # already on the target device, so the cache's own tensor would be handed out.
+                device_embed = embed.clone()
+            device_embeds.append(device_embed)
+        return tuple(device_embeds)
+
+    def _cache_prompt_embeds(self, cache_key: str, *embeds):
+        if not self._prompt_cache_enabled():
+            return
+        cache_size = int(self.config.sd3_prompt_cache_size)
+        if cache_key not in self._prompt_cache_seen:
+            # most captions are only ever encoded once, so copying them out would be wasted work.
+            self._prompt_cache_seen[cache_key] = None
+            while len(self._prompt_cache_seen) > cache_size * 8:
+                self._prompt_cache_seen.popitem(last=False)
+            return
+        del self._prompt_cache_seen[cache_key]
+        pin_memory = torch.cuda.is_available()
+        host_embeds = []
+        for embed in embeds:
+            host_embed = torch.empty(
+                embed.shape, dtype=embed.dtype, device="cpu", pin_memory=pin_memory
+            )
+            host_embed.copy_(embed.detach(), non_blocking=pin_memory)
+            host_embeds.append(host_embed)
+        copy_event = None
+        if pin_memory and embeds[0].is_cuda:
+            copy_event = torch.cuda.Event()
+            copy_event.record()
+        self._prompt_cache[cache_key] = (tuple(host_embeds), copy_event)
+        while len(self._prompt_cache) > cache_size:
+            self._prompt_cache.popitem(last=False)
+
+    def load_lora_weights(self, models, input_dir):
+        super().load_lora_weights(models, input_dir)
+        # text encoder adapters may have been swapped, so the cached embeds and graphs are stale.
+        self._prompt_cache.clear()
+        self._prompt_cache_seen.clear()
+        self._clip_graph_runners = {}
+
+    def unload_text_encoder(self):
+        super().unload_text_encoder()
+        # without the tokenisers, the tokeniser threads have nothing left to do.
+        if self._tokenizer_executor is not None:
+            self._tokenizer_executor.shutdown(wait=True)
+            self._tokenizer_executor = None
+        # the graph runners hold the old encoders along with their captured graphs' memory pools.
+        self._clip_graph_runners = {}
+
+    def offload_frozen_text_encoders(self):
+        """
+        T5 XXL is never trained, so after the text embeds are cached, it is only needed for uncached prompts.
+        Its weights are moved to system memory and streamed to the accelerator during each forward pass.
+        """
+        if self.text_encoders is None or len(self.text_encoders) < 3:
+            return
+        text_encoder = self.text_encoders[-1]
+        if getattr(text_encoder, "_hf_hook", None) is not None:
+            # already offloaded.
+            return
+        if self.config.text_encoder_3_precision not in ["no_change", None]:
+            logger.info(
+                f"Not offloading {self.TEXT_ENCODER_CONFIGURATION['text_encoder_3']['name']}, as it is quantised."
+            )
+            return
+        if getattr(text_encoder, "_compiled_call_impl", None) is not None:
+            # the offload hooks would end up underneath the compiled forward pass.
+            logger.info(
+                f"Not offloading {self.TEXT_ENCODER_CONFIGURATION['text_encoder_3']['name']}, as it was compiled by --sd3_text_encoder_compile."
+            )
+            return
+        from accelerate import cpu_offload
+
+        logger.info(
+            f"Offloading {self.TEXT_ENCODER_CONFIGURATION['text_encoder_3']['name']} to system memory."
+        )
+        cpu_offload(text_encoder, execution_device=self.accelerator.device)
+
+    def prepare_batch_conditions(self, batch: dict, state: dict) -> dict:
+        """
+        Moves the transformer inputs to their final device and dtype once per batch,
+        so that model_predict (which may run more than once per batch) can pass them straight through.
+        """
+        batch["noisy_latents"] = batch["noisy_latents"].to(
+            device=self.accelerator.device,
+            dtype=self.config.base_weight_dtype,
+        )
+        batch["encoder_hidden_states"] = batch["encoder_hidden_states"].to(
+            device=self.accelerator.device,
+            dtype=self.config.base_weight_dtype,
+        )
+        batch["add_text_embeds"] = batch["add_text_embeds"].to(
+            device=self.accelerator.device,
+            dtype=self.config.weight_dtype,
+        )
+        return batch
+
     def model_predict(self, prepared_batch):
         logger.debug(
             "Input shapes:"
@@ -244,21 +758,19 @@ class SD3(ImageModelFoundation):
             f"\n{prepared_batch['encoder_hidden_states'].shape}"
             f"\n{prepared_batch['add_text_embeds'].shape}"
         )
+        if logger.isEnabledFor(logging.DEBUG):
+            for key in ["noisy_latents", "encoder_hidden_states"]:
+                if prepared_batch[key].dtype != self.config.base_weight_dtype:
+                    logger.debug(
+                        f"Expected {key} in {self.config.base_weight_dtype} from prepare_batch_conditions, got {prepared_batch[key].dtype}."
+                    )
+        # inputs were already placed by prepare_batch_conditions.
         return {
             "model_prediction": self.model(
-                hidden_states=prepared_batch["noisy_latents"].to(
-                    device=self.accelerator.device,
-                    dtype=self.config.base_weight_dtype,
-                ),
+                hidden_states=prepared_batch["noisy_latents"],
                 timestep=prepared_batch["timesteps"],
-                encoder_hidden_states=prepared_batch["encoder_hidden_states"].to(
-                    device=self.accelerator.device,
-                    dtype=self.config.base_weight_dtype,
-                ),
-                pooled_projections=prepared_batch["add_text_embeds"].to(
-                    device=self.accelerator.device,
-                    dtype=self.config.weight_dtype,
-                ),
+                encoder_hidden_states=prepared_batch["encoder_hidden_states"],
+                pooled_projections=prepared_batch["add_text_embeds"],
                 return_dict=False,
             )[0]
         }
@@ -294,6 +806,11 @@ class SD3(ImageModelFoundation):
                 "MM-DiT requires an alignment value of 64px. Overriding the value of --aspect_bucket_alignment."
             )
             self.config.aspect_bucket_alignment = 64
+        if self.config.sd3_t5_dynamic_padding and self.config.t5_padding != "zero":
+            logger.warning(
+                f"{self.NAME} requires --t5_padding=zero for --sd3_t5_dynamic_padding, as the padded positions would otherwise differ. Disabling dynamic padding."
+            )
+            self.config.sd3_t5_dynamic_padding = False
         if self.config.sd3_t5_uncond_behaviour is None:
             self.config.sd3_t5_uncond_behaviour = self.config.sd3_clip_uncond_behaviour
         logger.info(
@@ -21,6 +21,9 @@ if torch.cuda.is_available():
     if primary_device.major >= 8:
         # Hopper! Or blackwell+.
         quantised_precision_levels.append("fp8-torchao")
+    if (primary_device.major, primary_device.minor) >= (8, 9):
+        # torchao's fp8 activation kernels need Ada or newer.
+        quantised_precision_levels.append("fp8dq-torchao")
 
 try:
     import pillow_jxl
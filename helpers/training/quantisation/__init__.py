@@ -181,6 +181,17 @@ def _torchao_model(
             module_filter_fn=_torchao_filter_fn,
             config=Float8LinearConfig(pad_inner_dim=True),
         )
+    elif model_precision == "fp8dq-torchao":
+        # inference-only: dynamically scaled fp8 activations against fp8 weights, for frozen text encoders.
+        from torchao.quantization import Float8DynamicActivationFloat8WeightConfig
+
+        quantize_(
+            model,
+            Float8DynamicActivationFloat8WeightConfig(),
+            # quantize_ offers every submodule to the filter, root included, but _torchao_filter_fn assumes a Linear.
+            filter_fn=lambda mod, fqn: isinstance(mod, torch.nn.Linear)
+            and _torchao_filter_fn(mod, fqn),
+        )
 
     else:
         raise ValueError(
@@ -570,6 +570,8 @@ class Trainer:
 
     def init_unload_text_encoder(self):
         if self.config.model_type != "full" and self.config.train_text_encoder:
+            # the trained text encoders have to stay, but frozen ones needn't occupy the accelerator.
+            self.model.offload_frozen_text_encoders()
             return
         memory_before_unload = self.stats_memory_used()
         if self.accelerator.is_main_process:
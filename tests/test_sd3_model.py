@@ -0,0 +1,188 @@
+import unittest
+from collections import OrderedDict
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import torch
+
+from helpers.models.common import ImageModelFoundation
+from helpers.models.sd3.model import SD3, _encode_t5_length_buckets
+
+
+def _make_sd3(cache_size: int = 2, train_text_encoder: bool = False):
+    # skip the foundation __init__, which would go looking for real weights.
+    model = SD3.__new__(SD3)
+    model.config = SimpleNamespace(
+        sd3_prompt_cache_size=cache_size,
+        train_text_encoder=train_text_encoder,
+    )
+    model.accelerator = SimpleNamespace(device=torch.device("cpu"))
+    model._prompt_cache = OrderedDict()
+    model._prompt_cache_seen = OrderedDict()
+    model._clip_graph_runners = {}
+    return model
+
+
+class TestSD3PromptCacheKey(unittest.TestCase):
+    def test_same_prompts_share_a_key(self):
+        self.assertEqual(
+            SD3._prompt_cache_key(["a cat"], 77, True),
+            SD3._prompt_cache_key("a cat", 77, True),
+        )
+
+    def test_encoding_options_change_the_key(self):
+        key = SD3._prompt_cache_key(["a cat"], 77, True)
+        self.assertNotEqual(key, SD3._prompt_cache_key(["a dog"], 77, True))
+        self.assertNotEqual(key, SD3._prompt_cache_key(["a cat"], 154, True))
+        self.assertNotEqual(key, SD3._prompt_cache_key(["a cat"], 77, False))
+        self.assertNotEqual(
+            key, SD3._prompt_cache_key(["a cat"], 77, True, dynamic_padding=True)
+        )
+
+    def test_prompt_boundaries_change_the_key(self):
+        self.assertNotEqual(
+            SD3._prompt_cache_key(["a", "b c"], 77, True),
+            SD3._prompt_cache_key(["a b", "c"], 77, True),
+        )
+
+
+class TestSD3PromptCache(unittest.TestCase):
+    def _store(self, model, key, value: float):
+        embeds = (torch.full((1, 3, 4), value), torch.full((1, 4), value))
+        model._cache_prompt_embeds(key, *embeds)
+        return embeds
+
+    def test_prompt_is_cached_once_it_repeats(self):
+        model = _make_sd3()
+        self._store(model, "a", 1.0)
+        self.assertIsNone(model._get_cached_prompt_embeds("a"))
+        prompt_embeds, pooled_prompt_embeds = self._store(model, "a", 1.0)
+        cached_embeds, cached_pooled_embeds = model._get_cached_prompt_embeds("a")
+        self.assertTrue(torch.equal(cached_embeds, prompt_embeds))
+        self.assertTrue(torch.equal(cached_pooled_embeds, pooled_prompt_embeds))
+
+    def test_cache_hits_do_not_share_storage(self):
+        model = _make_sd3()
+        self._store(model, "a", 1.0)
+        self._store(model, "a", 1.0)
+        first_hit = model._get_cached_prompt_embeds("a")
+        second_hit = model._get_cached_prompt_embeds("a")
+        for first_embed, second_embed in zip(first_hit, second_hit):
+            self.assertNotEqual(first_embed.data_ptr(), second_embed.data_ptr())
+        # editing a returned embed in-place must leave the cached copy untouched.
+        first_hit[0].zero_()
+        self.assertTrue(
+            torch.equal(model._get_cached_prompt_embeds("a")[0], second_hit[0])
+        )
+
+    def test_least_recently_used_prompt_is_evicted(self):
+        model = _make_sd3(cache_size=2)
+        for key in ["a", "b", "a", "b"]:
+            self._store(model, key, 1.0)
+        # touching "a" makes "b" the oldest entry.
+        self.assertIsNotNone(model._get_cached_prompt_embeds("a"))
+        self._store(model, "c", 1.0)
+        self._store(model, "c", 1.0)
+        self.assertEqual(list(model._prompt_cache.keys()), ["a", "c"])
+        self.assertIsNone(model._get_cached_prompt_embeds("b"))
+
+    def test_cache_is_bypassed_when_training_text_encoders(self):
+        model = _make_sd3(train_text_encoder=True)
+        self._store(model, "a", 1.0)
+        self._store(model, "a", 1.0)
+        self.assertEqual(len(model._prompt_cache), 0)
+        self.assertIsNone(model._get_cached_prompt_embeds("a"))
+
+    def test_cache_is_disabled_by_a_zero_size(self):
+        model = _make_sd3(cache_size=0)
+        self._store(model, "a", 1.0)
+        self._store(model, "a", 1.0)
+        self.assertIsNone(model._get_cached_prompt_embeds("a"))
+
+    def test_loading_lora_weights_clears_the_cache(self):
+        model = _make_sd3()
+        self._store(model, "a", 1.0)
+        self._store(model, "a", 1.0)
+        self._store(model, "b", 1.0)
+        with patch.object(ImageModelFoundation, "load_lora_weights") as load:
+            model.load_lora_weights([], "/tmp/checkpoint")
+        load.assert_called_once_with([], "/tmp/checkpoint")
+        self.assertEqual(len(model._prompt_cache), 0)
+        self.assertEqual(len(model._prompt_cache_seen), 0)
+        self.assertIsNone(model._get_cached_prompt_embeds("a"))
+
+
+class _StubTokenizer:
+    def pad(self, encoded_inputs, padding, return_tensors):
+        assert padding == "longest" and return_tensors == "pt"
+        input_ids = encoded_inputs["input_ids"]
+        longest = max(len(ids) for ids in input_ids)
+        return SimpleNamespace(
+            input_ids=torch.tensor(
+                [ids + [0] * (longest - len(ids)) for ids in input_ids]
+            ),
+            attention_mask=torch.tensor(
+                [[1] * len(ids) + [0] * (longest - len(ids)) for ids in input_ids]
+            ),
+        )
+
+
+class _StubT5:
+    """
+    Echoes each token id into both channels of its embed, so the output shows where every token ended up.
+    """
+
+    def __init__(self):
+        self.batch_shapes = []
+
+    def __call__(self, input_ids, attention_mask):
+        self.batch_shapes.append(tuple(input_ids.shape))
+        embeds = (input_ids * attention_mask).float().unsqueeze(-1).expand(-1, -1, 2)
+        return (embeds,)
+
+
+class TestSD3T5LengthBuckets(unittest.TestCase):
+    def _encode(self, input_ids, **kwargs):
+        text_encoder = _StubT5()
+        prompt_embeds = _encode_t5_length_buckets(
+            text_encoder,
+            _StubTokenizer(),
+            input_ids,
+            device="cpu",
+            max_sequence_length=16,
+            **kwargs,
+        )
+        return prompt_embeds, text_encoder.batch_shapes
+
+    def _assert_embeds_match(self, prompt_embeds, input_ids):
+        self.assertEqual(tuple(prompt_embeds.shape), (len(input_ids), 16, 2))
+        for idx, ids in enumerate(input_ids):
+            expected = torch.zeros(16)
+            expected[: len(ids)] = torch.tensor(ids, dtype=torch.float)
+            self.assertTrue(torch.equal(prompt_embeds[idx, :, 0], expected))
+            self.assertTrue(torch.equal(prompt_embeds[idx, :, 1], expected))
+
+    def test_small_batch_runs_in_one_forward_pass(self):
+        input_ids = [[1, 2, 3, 4, 5, 6], [7], [8, 9, 10], [11, 12]]
+        prompt_embeds, batch_shapes = self._encode(input_ids)
+        self.assertEqual(batch_shapes, [(4, 6)])
+        self._assert_embeds_match(prompt_embeds, input_ids)
+
+    def test_mixed_lengths_are_returned_in_prompt_order(self):
+        # interleave short and long prompts, so that sorting by length shuffles them.
+        input_ids = []
+        for idx in range(4):
+            input_ids.append(list(range(100 + idx * 10, 110 + idx * 10)))
+            input_ids.append([idx + 1, idx + 2])
+        prompt_embeds, batch_shapes = self._encode(input_ids, min_bucket_size=2)
+        self.assertEqual(batch_shapes, [(4, 2), (4, 10)])
+        self._assert_embeds_match(prompt_embeds, input_ids)
+
+    def test_evenly_sized_prompts_are_not_split(self):
+        input_ids = [list(range(1, length + 1)) for length in [5, 6, 7, 8, 9, 10]]
+        _, batch_shapes = self._encode(input_ids, min_bucket_size=2)
+        self.assertEqual(batch_shapes, [(6, 10)])
+
+
+if __name__ == "__main__":
+    unittest.main()